@@ -1,86 +1,356 @@
 import os
+import math
+import glob
 import sys
 import time
 import threading
 import psutil
-from collections import defaultdict
-from datetime import datetime
+from collections import defaultdict, deque
+
+_NOT_TARGET = (None, False, None)
 
 class FunctionProfiler:
-    def __init__(self, target_script):
+    def __init__(self, target_script, sampling=False, sample_interval=1.0):
         self.process = psutil.Process(os.getpid())
+        self.process.cpu_percent()  # seed so the first sample has a baseline
+        # cpu_percent() is relative to one core; normalize by the cores this
+        # process may actually run on so 100% means fully using them
+        if hasattr(os, 'sched_getaffinity'):
+            self.cpu_count = len(os.sched_getaffinity(0))
+        else:
+            self.cpu_count = psutil.cpu_count() or 1
         self.target_script = os.path.abspath(target_script)
-        self.function_stats = defaultdict(list)
-        self.call_stack = []
-        self.lock = threading.Lock()
+        # Running totals per unique call stack; raw samples are not retained
+        self.stack_stats = {}  # call stack tuple -> aggregate dict
+        # One call stack per thread, keyed by thread ident. append/pop on a
+        # deque are atomic under the GIL, so the tracer and the monitor
+        # thread share them without a lock
+        self.call_stacks = {}
         self.stop_event = threading.Event()
-        self.sample_interval = 1.0  # 1 second intervals for better CPU accuracy
-        self.per_second_log = []
+        self.sample_interval = sample_interval  # 1 second default for better CPU accuracy
+        self.per_second_rows = []
         self.call_counts = defaultdict(int)
+        self._target_prefix = self.target_script
+        # Target or not is decided per co_filename (one entry per file, and
+        # str caches its hash); only code objects from the target file are
+        # pinned in _code_cache, so eval/exec and library code can be freed
+        self._target_files = {}
+        self._code_cache = {}
+        # Sampling mode reads every thread's frames from the monitor thread
+        # instead of installing a profile hook
+        self.sampling = sampling
+        self._sampled_keys = set()  # (id(frame), id(code)) seen at the last sample
+        self.energy_domains = self._open_energy_domains()
+        # Fixed at startup so the tables keep their columns even if a domain
+        # becomes unreadable mid-run
+        self.show_energy = bool(self.energy_domains)
+        self._monitored_codes = {}  # id(code) -> code with local events set
+        self._using_monitoring = False
+
+    def _open_energy_domains(self):
+        # Top-level Intel RAPL domains only; intel-rapl:N:M subdomains are
+        # already included in their package's counter
+        domains = []
+        for path in sorted(glob.glob('/sys/class/powercap/intel-rapl:*')):
+            if os.path.basename(path).count(':') != 1:
+                continue
+            try:
+                with open(os.path.join(path, 'max_energy_range_uj')) as f:
+                    max_range = int(f.read())
+                counter = open(os.path.join(path, 'energy_uj'))
+            except (OSError, ValueError):
+                continue
+            try:
+                value = int(counter.read())
+            except (OSError, ValueError):
+                counter.close()
+                continue
+            domains.append([counter, max_range, value])
+        return domains
+
+    def read_energy_uj(self):
+        total = 0
+        for domain in list(self.energy_domains):
+            counter, max_range, previous = domain
+            try:
+                counter.seek(0)
+                value = int(counter.read())
+            except (OSError, ValueError):
+                # Stop reading a domain that became unreadable rather than
+                # letting the error end the monitor thread
+                counter.close()
+                self.energy_domains.remove(domain)
+                continue
+            total += (value - previous) % max_range  # counter wraps at max_range
+            domain[2] = value
+        return total
+
+    def close_energy_domains(self):
+        for counter, _, _ in self.energy_domains:
+            counter.close()
+
+    def per_second_header(self):
+        header = "{:<10} {:<8} {:<10}".format("Time", "CPU%", "Mem(MB)")
+        if self.show_energy:
+            header += " {:<10}".format("Energy(J)")
+        return header + " {:<50}\n".format("Active Functions")
 
     def start_monitoring(self):
         print("\n[+] Real-Time Per-Second Resource Usage:")
-        print("{:<10} {:<8} {:<10} {:<50}".format("Time", "CPU%", "Mem(MB)", "Active Functions"))
-
-        while not self.stop_event.is_set():
-            start_time = time.time()
-            cpu = self.process.cpu_percent(interval=self.sample_interval)
-            mem = self.process.memory_info().rss / (1024 * 1024)  # MB
-            current_time = time.time()
-
-            with self.lock:
-                active_funcs = list(set(self.call_stack)) if self.call_stack else ['<main>']
-                for func_id in active_funcs:
-                    self.function_stats[func_id].append((current_time, cpu, mem))
-
-                log_entry = {
-                    'timestamp': datetime.fromtimestamp(current_time).strftime('%H:%M:%S'),
-                    'cpu': cpu,
-                    'mem': mem,
-                    'active_functions': active_funcs
+        sys.stdout.write(self.per_second_header())
+
+        process = self.process
+        stop_event = self.stop_event
+        interval = self.sample_interval
+        cpu_count = self.cpu_count
+        call_stacks = self.call_stacks
+        sampling = self.sampling
+        sample_call_stack = self.sample_call_stack
+        stack_stats = self.stack_stats
+        per_second_rows = self.per_second_rows
+        write = sys.stdout.write
+        energy_domains = self.energy_domains
+        read_energy_uj = self.read_energy_uj
+        show_energy = self.show_energy
+
+        # Ticks are scheduled against fixed monotonic deadlines so per-tick
+        # work does not accumulate as drift
+        next_tick = time.monotonic()
+        last_second = None
+        while True:
+            next_tick += interval
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                if stop_event.wait(delay):
+                    break
+            else:
+                next_tick = time.monotonic()  # fell behind, resync instead of bursting
+                if stop_event.is_set():
+                    break
+
+            with process.oneshot():
+                cpu = process.cpu_percent() / cpu_count
+                mem = process.memory_info().rss / (1024 * 1024)  # MB
+            energy = read_energy_uj() if energy_domains else 0  # μJ since last tick
+            current_time = time.monotonic()
+            wall_second = int(time.time())
+            if wall_second != last_second:
+                last_second = wall_second
+                tm = time.localtime(wall_second)
+                clock_label = f"{tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d}"
+
+            if sampling:
+                stack = sample_call_stack()
+            else:
+                # Concatenate the threads' stacks; aggregation attributes the
+                # sample to the union of their functions
+                stack = tuple(func_id for thread_stack in list(call_stacks.values())
+                              for func_id in tuple(thread_stack))
+            agg = stack_stats.get(stack)
+            if agg is None:
+                agg = stack_stats[stack] = {
+                    'samples': 0,
+                    'total_cpu': 0,
+                    'max_cpu': 0,
+                    'total_mem': 0,
+                    'max_mem': 0,
+                    'total_energy': 0,
+                    'first_seen': current_time,
                 }
-                self.per_second_log.append(log_entry)
-
-                print("{:<10} {:<8.1f} {:<10.1f} {:<50}".format(
-                    log_entry['timestamp'], 
-                    log_entry['cpu'], 
-                    log_entry['mem'], 
-                    ", ".join(log_entry['active_functions'])
-                ))
-
-    def function_enter(self, frame):
-        filename = os.path.abspath(frame.f_code.co_filename)
-        if not filename.startswith(self.target_script):
+            agg['samples'] += 1
+            agg['total_cpu'] += cpu
+            agg['total_mem'] += mem
+            agg['total_energy'] += energy
+            if cpu > agg['max_cpu']:
+                agg['max_cpu'] = cpu
+            if mem > agg['max_mem']:
+                agg['max_mem'] = mem
+            agg['last_seen'] = current_time
+
+            active_funcs = list(set(stack)) if stack else ['<main>']
+            # Formatted once and reused for the end-of-run table
+            if show_energy:
+                row = "{:<10} {:<8.1f} {:<10.1f} {:<10.3f} {:<50}\n".format(
+                    clock_label, cpu, mem, energy / 1e6, ", ".join(active_funcs)
+                )
+            else:
+                row = "{:<10} {:<8.1f} {:<10.1f} {:<50}\n".format(
+                    clock_label, cpu, mem, ", ".join(active_funcs)
+                )
+            per_second_rows.append(row)
+            write(row)
+
+        self._sampled_keys.clear()
+
+    def sample_call_stack(self):
+        frames = []
+        for frame in sys._current_frames().values():
+            thread_frames = []
+            while frame is not None:
+                code = frame.f_code
+                func_id, is_target, _ = self._code_cache.get(id(code)) or self._code_info(code)
+                if is_target:
+                    thread_frames.append((func_id, frame))
+                frame = frame.f_back
+            thread_frames.reverse()
+            frames.extend(thread_frames)
+
+        # Approximate call counts: a frame that was not on the stack at the
+        # previous sample is counted as a new call. Frames are not retained
+        # (that would keep their locals alive and skew the memory numbers),
+        # so a recycled frame id is told apart by its code object, which
+        # _code_cache keeps alive.
+        previous = self._sampled_keys
+        current = set()
+        for func_id, frame in frames:
+            key = (id(frame), id(frame.f_code))
+            current.add(key)
+            if key not in previous:
+                self.call_counts[func_id] += 1
+        self._sampled_keys = current
+
+        return tuple(func_id for func_id, _ in frames)
+
+    def install_hooks(self):
+        if sys.version_info >= (3, 12) and self._install_monitoring():
             return
-
-        func_name = frame.f_code.co_name
-        if func_name == '<module>':
+        threading.setprofile(self.tracer)
+        sys.setprofile(self.tracer)
+
+    def remove_hooks(self):
+        if self._using_monitoring:
+            self._remove_monitoring()
+        else:
+            sys.setprofile(None)
+            threading.setprofile(None)
+
+    def _install_monitoring(self):
+        monitoring = sys.monitoring
+        tool_id = monitoring.PROFILER_ID
+        try:
+            monitoring.use_tool_id(tool_id, "universal_profiler")
+        except ValueError:
+            return False  # tool id taken (e.g. by cProfile); fall back to setprofile
+
+        events = monitoring.events
+        monitoring.register_callback(tool_id, events.PY_START, self._on_py_start)
+        monitoring.register_callback(tool_id, events.PY_RESUME, self._on_py_resume)
+        monitoring.register_callback(tool_id, events.PY_THROW, self._on_py_throw)
+        for event in (events.PY_RETURN, events.PY_YIELD, events.PY_UNWIND):
+            monitoring.register_callback(tool_id, event, self._on_py_exit)
+        # PY_START is global only to discover target code objects; every other
+        # code object disables it for itself on first sight. PY_THROW and
+        # PY_UNWIND cannot be set per code object, so they stay global and
+        # function_enter/function_exit filter them.
+        monitoring.set_events(tool_id, events.PY_START | events.PY_THROW | events.PY_UNWIND)
+        self._using_monitoring = True
+        return True
+
+    def _remove_monitoring(self):
+        monitoring = sys.monitoring
+        tool_id = monitoring.PROFILER_ID
+        events = monitoring.events
+        monitoring.set_events(tool_id, 0)
+        for code in self._monitored_codes.values():
+            monitoring.set_local_events(tool_id, code, 0)
+        for event in (events.PY_START, events.PY_RESUME, events.PY_THROW,
+                      events.PY_RETURN, events.PY_YIELD, events.PY_UNWIND):
+            monitoring.register_callback(tool_id, event, None)
+        monitoring.free_tool_id(tool_id)
+        self._using_monitoring = False
+
+    def _on_py_start(self, code, instruction_offset):
+        func_id, is_target, _ = self._code_cache.get(id(code)) or self._code_info(code)
+        if not is_target:
+            return sys.monitoring.DISABLE
+        if id(code) not in self._monitored_codes:
+            self._monitored_codes[id(code)] = code
+            events = sys.monitoring.events
+            sys.monitoring.set_local_events(
+                sys.monitoring.PROFILER_ID, code,
+                events.PY_RESUME | events.PY_RETURN | events.PY_YIELD
+            )
+        self.function_enter(code)
+
+    def _on_py_resume(self, code, instruction_offset):
+        self.function_enter(code)
+
+    def _on_py_throw(self, code, instruction_offset, exception):
+        # A generator resumed by throw()/close() gets no PY_RESUME; setprofile
+        # reports it as 'call', so count it as an entry too
+        self.function_enter(code)
+
+    def _on_py_exit(self, code, instruction_offset, arg):
+        self.function_exit(code)
+
+    def tracer(self, frame, event, arg):
+        if event == 'call':
+            self.function_enter(frame.f_code)
+        elif event == 'return':
+            self.function_exit(frame.f_code)
+
+    def _normalize_filename(self, filename):
+        # Absolute names can still contain '..' (e.g. the target script given
+        # as /a/../a/x.py); normpath them without abspath's getcwd call
+        if os.path.isabs(filename):
+            return os.path.normpath(filename)
+        return os.path.abspath(filename)
+
+    def _code_info(self, code):
+        is_target_file = self._target_files.get(code.co_filename)
+        if is_target_file is None:
+            filename = self._normalize_filename(code.co_filename)
+            is_target_file = filename.startswith(self._target_prefix)
+            self._target_files[code.co_filename] = is_target_file
+        if not is_target_file:
+            return _NOT_TARGET
+
+        filename = self._normalize_filename(code.co_filename)
+        is_target = code.co_name != '<module>'
+        # Interned so every code object with the same id shares one string and
+        # dict/stack comparisons short-circuit on identity
+        func_id = sys.intern(f"{os.path.basename(filename)}:{code.co_name}:{code.co_firstlineno}")
+        # Keep a reference to the code object so its id() cannot be reused
+        entry = self._code_cache[id(code)] = (func_id, is_target, code)
+        return entry
+
+    def function_enter(self, code):
+        entry = self._code_cache.get(id(code))
+        if entry is None:
+            if self._target_files.get(code.co_filename) is False:
+                return
+            entry = self._code_info(code)
+        func_id, is_target, _ = entry
+        if not is_target:
             return
 
-        lineno = frame.f_lineno
-        func_id = f"{os.path.basename(filename)}:{func_name}:{lineno}"
-
-        with self.lock:
-            self.call_stack.append(func_id)
-            self.call_counts[func_id] += 1
-
-    def function_exit(self, frame):
-        filename = os.path.abspath(frame.f_code.co_filename)
-        if not filename.startswith(self.target_script):
+        tid = threading.get_ident()
+        stack = self.call_stacks.get(tid)
+        if stack is None:
+            stack = self.call_stacks[tid] = deque()
+        stack.append(func_id)
+        self.call_counts[func_id] += 1
+
+    def function_exit(self, code):
+        entry = self._code_cache.get(id(code))
+        if entry is None:
+            if self._target_files.get(code.co_filename) is False:
+                return
+            entry = self._code_info(code)
+        func_id, is_target, _ = entry
+        if not is_target:
             return
 
-        func_name = frame.f_code.co_name
-        if func_name == '<module>':
+        stack = self.call_stacks.get(threading.get_ident())
+        if not stack:
             return
-
-        lineno = frame.f_lineno
-        func_id = f"{os.path.basename(filename)}:{func_name}:{lineno}"
-
-        with self.lock:
-            if func_id in self.call_stack:
-                self.call_stack.reverse()
-                self.call_stack.remove(func_id)
-                self.call_stack.reverse()
+        if stack[-1] == func_id:
+            stack.pop()
+            return
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i] == func_id:
+                del stack[i]
+                break
 
     def get_aggregated_stats(self):
         aggregated = defaultdict(lambda: {
@@ -90,93 +360,109 @@ class FunctionProfiler:
             'max_cpu': 0,
             'total_mem': 0,
             'max_mem': 0,
+            'total_energy': 0,
             'first_seen': float('inf'),
             'last_seen': 0
         })
 
-        for func_id, samples in self.function_stats.items():
-            if not samples:
-                continue
-
-            calls = self.call_counts.get(func_id, 0)
-            aggregated[func_id]['calls'] = calls
-
-            first_time = samples[0][0]
-            last_time = samples[-1][0]
-            aggregated[func_id]['first_seen'] = min(aggregated[func_id]['first_seen'], first_time)
-            aggregated[func_id]['last_seen'] = max(aggregated[func_id]['last_seen'], last_time)
-            aggregated[func_id]['total_time'] += (last_time - first_time)
-
-            cpu_values = [s[1] for s in samples]
-            aggregated[func_id]['total_cpu'] += sum(cpu_values)
-            aggregated[func_id]['max_cpu'] = max(cpu_values)
-
-            mem_values = [s[2] for s in samples]
-            aggregated[func_id]['total_mem'] += sum(mem_values)
-            aggregated[func_id]['max_mem'] = max(mem_values)
-
-        for func_id in aggregated:
-            sample_count = len(self.function_stats[func_id])
-            if sample_count > 0:
-                aggregated[func_id]['avg_cpu'] = aggregated[func_id]['total_cpu'] / sample_count
-                aggregated[func_id]['avg_mem'] = aggregated[func_id]['total_mem'] / sample_count
-            else:
-                aggregated[func_id]['avg_cpu'] = 0
-                aggregated[func_id]['avg_mem'] = 0
+        sample_counts = defaultdict(int)
+        for stack, agg in self.stack_stats.items():
+            for func_id in (set(stack) if stack else {'<main>'}):
+                data = aggregated[func_id]
+                sample_counts[func_id] += agg['samples']
+                data['first_seen'] = min(data['first_seen'], agg['first_seen'])
+                data['last_seen'] = max(data['last_seen'], agg['last_seen'])
+                data['total_cpu'] += agg['total_cpu']
+                data['max_cpu'] = max(data['max_cpu'], agg['max_cpu'])
+                data['total_mem'] += agg['total_mem']
+                data['max_mem'] = max(data['max_mem'], agg['max_mem'])
+                data['total_energy'] += agg['total_energy']
+
+        for func_id, data in aggregated.items():
+            sample_count = sample_counts[func_id]
+            data['calls'] = self.call_counts.get(func_id, 0)
+            data['total_time'] = data['last_seen'] - data['first_seen']
+            data['avg_cpu'] = data['total_cpu'] / sample_count
+            data['avg_mem'] = data['total_mem'] / sample_count
+            data['total_energy'] /= 1e6  # μJ -> J
 
         return aggregated
 
-def profile_script(script_path):
-    profiler = FunctionProfiler(script_path)
+def profile_script(script_path, sampling=False, sample_interval=1.0):
+    profiler = FunctionProfiler(script_path, sampling=sampling, sample_interval=sample_interval)
 
     monitor_thread = threading.Thread(target=profiler.start_monitoring)
     monitor_thread.daemon = True
     monitor_thread.start()
 
-    def tracer(frame, event, arg):
-        if event == 'call':
-            profiler.function_enter(frame)
-        elif event == 'return':
-            profiler.function_exit(frame)
-        return tracer
-
-    sys.settrace(tracer)
+    if not sampling:
+        profiler.install_hooks()
     try:
         with open(script_path) as f:
             code = compile(f.read(), script_path, 'exec')
         exec(code, {'__name__': '__main__'})
     finally:
-        sys.settrace(None)
+        if not sampling:
+            profiler.remove_hooks()
         profiler.stop_event.set()
         monitor_thread.join(timeout=2.0)
+        profiler.close_energy_domains()
 
-    print("\n[+] Per-Second Resource Usage:")
-    print("{:<10} {:<8} {:<10} {:<50}".format("Time", "CPU%", "Mem(MB)", "Active Functions"))
-    for entry in profiler.per_second_log:
-        print("{:<10} {:<8.1f} {:<10.1f} {:<50}".format(
-            entry['timestamp'], entry['cpu'], entry['mem'], 
-            ", ".join(entry['active_functions'])
-        ))
+    out = ["\n[+] Per-Second Resource Usage:\n"]
+    out.append(profiler.per_second_header())
+    out.extend(profiler.per_second_rows)
 
-    print("\n[+] Function Statistics:")
-    print("{:<35} {:<8} {:<12} {:<10} {:<10} {:<10} {:<10}".format(
+    out.append("\n[+] Function Statistics:\n")
+    if sampling:
+        out.append("(sampled: call counts are estimated from stack samples)\n")
+    show_energy = profiler.show_energy
+    header = "{:<35} {:<8} {:<12} {:<10} {:<10} {:<10} {:<10}".format(
         "Function", "Calls", "Total Time", "Avg CPU%", "Max CPU%", "Avg Mem", "Max Mem"
-    ))
+    )
+    if show_energy:
+        header += " {:<10}".format("Energy(J)")
+    out.append(header + "\n")
 
     stats = profiler.get_aggregated_stats()
     for func, data in sorted(stats.items(), key=lambda x: -x[1]['total_time']):
-        print("{:<35} {:<8} {:<12.3f} {:<10.1f} {:<10.1f} {:<10.1f} {:<10.1f}".format(
+        row = "{:<35} {:<8} {:<12.3f} {:<10.1f} {:<10.1f} {:<10.1f} {:<10.1f}".format(
             func, data['calls'], data['total_time'],
             data['avg_cpu'], data['max_cpu'], data['avg_mem'], data['max_mem']
-        ))
+        )
+        if show_energy:
+            row += " {:<10.3f}".format(data['total_energy'])
+        out.append(row + "\n")
+
+    sys.stdout.writelines(out)
+    sys.stdout.flush()
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python profiler.py <your_script.py>")
+    usage = "Usage: python profiler.py [--sample] [--interval SECONDS] <your_script.py>"
+    args = sys.argv[1:]
+    sampling = '--sample' in args
+    if sampling:
+        args.remove('--sample')
+
+    sample_interval = 1.0
+    if '--interval' in args:
+        i = args.index('--interval')
+        try:
+            sample_interval = float(args[i + 1])
+        except (IndexError, ValueError):
+            sample_interval = 0
+        # float() accepts nan/inf, and Event.wait() rejects timeouts above
+        # TIMEOUT_MAX, so both would break the monitor loop
+        if not math.isfinite(sample_interval) or not 0 < sample_interval <= threading.TIMEOUT_MAX:
+            print(usage)
+            sys.exit(1)
+        del args[i:i + 2]
+
+    if len(args) != 1:
+        print(usage)
         sys.exit(1)
 
-    if not os.path.exists(sys.argv[1]):
-        print(f"Error: File {sys.argv[1]} not found")
+    if not os.path.exists(args[0]):
+        print(f"Error: File {args[0]} not found")
         sys.exit(1)
 
-    profile_script(sys.argv[1])
+    profile_script(args[0], sampling=sampling, sample_interval=sample_interval)